@@ -1,14 +1,14 @@
 from __future__ import annotations
 
+import functools
 import hashlib
 import re
 from datetime import datetime, timedelta, timezone
 from typing import Any, Dict, Optional, Tuple
 
-import requests
 import streamlit as st
 
-from src.tdnet import fetch_tdnet_items
+from src.tdnet import fetch_tdnet_items, parse_dt_utc
 from src.analyzer import analyze_pdf_to_json, ai_is_enabled
 from src.storage import init_db, get_cached_analysis, save_analysis, db_path_default
 from src.viz import render_analysis
@@ -18,119 +18,77 @@ from src.viz import render_analysis
 # ----------------------------
 
 _JST = timezone(timedelta(hours=9))
+_UTC = timezone.utc
 
 # 決算っぽいタイトル判定（ゆるめ）
-_KESSAN_RE = re.compile(
-    r"(決算短信|四半期決算|通期決算|Financial Results|Earnings|Results)",
-    re.IGNORECASE,
-)
+# 日本語タイトルは素の部分文字列で先に判定し、正規表現は英語タイトルだけに使う
+_KESSAN_JA = ("決算短信", "四半期決算", "通期決算")
+_KESSAN_EN_RE = re.compile(r"Results|Earnings", re.IGNORECASE)
 
 
 def is_kessan(title: str) -> bool:
-    return bool(_KESSAN_RE.search(title or ""))
+    t = title or ""
+    for w in _KESSAN_JA:
+        if w in t:
+            return True
+    return bool(_KESSAN_EN_RE.search(t))
 
 
-def _parse_dt_any(value: Any) -> Optional[datetime]:
-    """
-    published_at の揺れに耐える：
-      - ISO: 2026-02-06T20:00:00Z / +09:00
-      - スペース区切り: 2026-02-06 20:00:00  (←JST想定)
-    返り値はUTC tz-aware datetime
-    """
-    if not value:
-        return None
-    s = str(value).strip()
-    if not s:
-        return None
-
-    # ISO Z 対応
-    s_iso = s.replace("Z", "+00:00")
-    try:
-        dt = datetime.fromisoformat(s_iso)
-        if dt.tzinfo is None:
-            dt = dt.replace(tzinfo=_JST)  # tz無しはJST想定
-        return dt.astimezone(timezone.utc)
-    except Exception:
-        pass
-
-    # "YYYY-MM-DD HH:MM:SS" / "YYYY/MM/DD HH:MM:SS"
-    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y/%m/%d %H:%M:%S"):
-        try:
-            dt = datetime.strptime(s, fmt).replace(tzinfo=_JST)
-            return dt.astimezone(timezone.utc)
-        except Exception:
-            continue
-
-    return None
+def _s(x: Any) -> str:
+    """None/空は ""、それ以外は str 化して strip（str ならそのまま strip）。"""
+    if not x:
+        return ""
+    return x.strip() if isinstance(x, str) else str(x).strip()
 
 
-def _extract_tdnet_fields(it: Dict[str, Any]) -> Tuple[str, str, str, Optional[datetime], str]:
+def _extract_tdnet_fields(
+    it: Dict[str, Any], raw: Optional[Dict[str, Any]]
+) -> Tuple[str, str, str, Optional[datetime], str]:
     """
     it の正規化が壊れても app 側で復元する（壊れづらさ優先）。
+    raw は it["raw"]（dict でなければ呼び出し側で None にしておく）。
     戻り: (title, code_raw, doc_url, published_at_utc, company_name)
     """
-    title = (it.get("title") or "").strip()
+    it_get = it.get
+    title = _s(it_get("title"))
 
     # codeは揺れるので広めに拾う（code/company_code/code4）
-    code = str(
-        it.get("code")
-        or it.get("company_code")
-        or it.get("code4")
-        or ""
-    ).strip()
+    code = _s(it_get("code") or it_get("company_code") or it_get("code4"))
 
-    company_name = str(it.get("company_name") or it.get("name") or "").strip()
-    doc_url = (it.get("doc_url") or it.get("document_url") or it.get("url") or "").strip()
-    published_at = it.get("published_at") or it.get("pubdate") or it.get("date")
+    company_name = _s(it_get("company_name") or it_get("name"))
+    doc_url = _s(it_get("doc_url") or it_get("document_url") or it_get("url"))
+    published_at = it_get("published_at") or it_get("pubdate") or it_get("date")
 
     if not isinstance(published_at, datetime):
-        published_at = _parse_dt_any(published_at)
+        published_at = parse_dt_utc(published_at)
+
+    # 全部そろっていれば raw を見る必要はない
+    if title and code and doc_url and company_name and published_at is not None:
+        return title, code, doc_url, published_at, company_name
 
     # raw から救済（it["raw"] の下が Tdnet/TDnet/直下 など揺れる）
-    raw = it.get("raw") if isinstance(it.get("raw"), dict) else {}
-    td: Any = None
-    if isinstance(raw.get("Tdnet"), dict):
-        td = raw["Tdnet"]
-    elif isinstance(raw.get("TDnet"), dict):
-        td = raw["TDnet"]
-    elif isinstance(raw.get("tdnet"), dict):
-        td = raw["tdnet"]
-    elif isinstance(raw, dict):
-        td = raw
-
-    if isinstance(td, dict):
-        if not title:
-            title = str(td.get("title") or td.get("Title") or "").strip()
-
-        if not company_name:
-            company_name = str(
-                td.get("company_name")
-                or td.get("CompanyName")
-                or td.get("name")
-                or ""
-            ).strip()
-
-        # 4桁/5桁揺れ：company_code が 45230 みたいに末尾0のことがある
-        if not code:
-            code = str(
-                td.get("code")
-                or td.get("company_code")
-                or td.get("Code")
-                or td.get("code4")
-                or ""
-            ).strip()
-
-        if not doc_url:
-            doc_url = str(
-                td.get("document_url")
-                or td.get("documentUrl")
-                or td.get("doc_url")
-                or td.get("url")
-                or ""
-            ).strip()
-
-        if published_at is None:
-            published_at = _parse_dt_any(td.get("published_at") or td.get("pubdate") or td.get("date"))
+    # キーの大文字小文字揺れ（Title/title, CompanyName/company_name 等）は小文字化して1回で引く
+    if raw is None:
+        return title, code, doc_url, published_at, company_name
+    raw_lc = {k.lower(): v for k, v in raw.items()}
+    td = raw_lc.get("tdnet")
+    td_get = ({k.lower(): v for k, v in td.items()} if isinstance(td, dict) else raw_lc).get
+
+    if not title:
+        title = _s(td_get("title"))
+
+    if not company_name:
+        company_name = _s(td_get("company_name") or td_get("companyname") or td_get("name"))
+
+    # 4桁/5桁揺れ：company_code が 45230 みたいに末尾0のことがある
+    if not code:
+        code = _s(td_get("code") or td_get("company_code") or td_get("code4"))
+
+    if not doc_url:
+        doc_url = _s(td_get("document_url") or td_get("documenturl") or td_get("doc_url") or td_get("url"))
+
+    if published_at is None:
+        published_at = parse_dt_utc(td_get("published_at") or td_get("pubdate") or td_get("date"))
 
     return title, code, doc_url, published_at, company_name
 
@@ -148,56 +106,23 @@ def _code4(code: str) -> str:
     return c
 
 
+# AI解析を許可するPDF URL（release.tdnet.info 直 or yanoshin rd.php 経由）
+_ALLOWED_PDF_RE = re.compile(
+    r"^(?:https?://(?:www\.)?release\.tdnet\.info/.+\.pdf$"
+    r"|https?://webapi\.yanoshin\.jp/rd\.php\?.*release\.tdnet\.info.*\.pdf)",
+    re.IGNORECASE,
+)
+
+
+@functools.lru_cache(maxsize=2048)
 def _is_allowed_pdf_url(url: str) -> bool:
     """
     手動URL解析の安全策（壊れ防止）。
     - release.tdnet.info のPDF
     - yanoshin rd.php 経由で release.tdnet.info のPDF
+    rerun毎に全件で呼ばれるので結果はキャッシュする。
     """
-    u = (url or "").strip()
-    if not u:
-        return False
-    u_low = u.lower()
-    if "release.tdnet.info" in u_low and u_low.endswith(".pdf"):
-        return True
-    if "webapi.yanoshin.jp/rd.php?" in u_low and "release.tdnet.info" in u_low and ".pdf" in u_low:
-        return True
-    return False
-
-
-def _pdf_size_bytes(url: str, timeout: float = 10.0) -> Optional[int]:
-    """
-    HEAD で Content-Length を取得してPDFサイズ推定。
-    取れない/失敗は None。
-    """
-    try:
-        r = requests.head(url, allow_redirects=True, timeout=timeout)
-        if r.status_code >= 400:
-            return None
-        cl = r.headers.get("Content-Length")
-        if not cl:
-            return None
-        n = int(cl)
-        return n if n > 0 else None
-    except Exception:
-        return None
-
-
-def _check_pdf_size_or_warn(url: str, max_bytes: int) -> bool:
-    """
-    max_bytes>0 のとき、判明する範囲でサイズ上限超をブロック。
-    不明なら警告して通す（最終防御は analyzer 側推奨）。
-    """
-    if max_bytes <= 0:
-        return True
-    n = _pdf_size_bytes(url)
-    if n is None:
-        st.warning("PDFサイズ（Content-Length）が取得できませんでした。上限超の可能性がある場合は解析に失敗することがあります。")
-        return True
-    if n > max_bytes:
-        st.error(f"PDFが上限を超えています：{n/1024/1024:.1f}MB > {max_bytes/1024/1024:.1f}MB")
-        return False
-    return True
+    return bool(_ALLOWED_PDF_RE.match((url or "").strip()))
 
 
 def _safe_pdf_link(doc_url: str) -> None:
@@ -292,7 +217,7 @@ if code_in:
 # ----------------------------
 # Fetch TDnet index (non-scrape) + cache
 # ----------------------------
-cutoff_utc = datetime.now(timezone.utc) - timedelta(days=days)
+cutoff_utc = datetime.now(_UTC) - timedelta(days=days)
 
 
 @st.cache_data(ttl=60, show_spinner=False)
@@ -312,10 +237,15 @@ if show_debug:
 # ----------------------------
 normalized: list[dict[str, Any]] = []
 for it in items:
-    if not isinstance(it, dict):
+    # dict 以外（壊れた要素）は .get が無いので飛ばす。raw の型チェックもここで1回だけ
+    try:
+        raw = it.get("raw")
+    except AttributeError:
         continue
+    if not isinstance(raw, dict):
+        raw = None
 
-    title, code_raw, doc_url, published_at, company_name = _extract_tdnet_fields(it)
+    title, code_raw, doc_url, published_at, company_name = _extract_tdnet_fields(it, raw)
     code4 = _code4(code_raw)
 
     normalized.append(
@@ -326,34 +256,39 @@ for it in items:
             "code_raw": code_raw,
             "doc_url": doc_url,
             "published_at": published_at,  # UTC
-            "raw": it.get("raw") if isinstance(it.get("raw"), dict) else it,
+            "raw": raw if raw is not None else it,
         }
     )
 
 
-def apply_filters(use_kessan: bool) -> list[dict[str, Any]]:
-    out: list[dict[str, Any]] = []
-    for it in normalized:
-        title = it.get("title", "")
-        doc_url = (it.get("doc_url") or "").strip()
-        published = it.get("published_at")
+# フィルタ用の索引（title/doc_url/published_at は上で正規化済み）
+index: list[tuple[str, str, Optional[datetime]]] = [
+    (it["title"], it["doc_url"], it["published_at"]) for it in normalized
+]
+
 
+def apply_filters(use_kessan: bool) -> list[int]:
+    """条件に合う normalized のインデックスを返す。"""
+    out: list[int] = []
+    for i, (title, doc_url, published) in enumerate(index):
         if use_kessan and not is_kessan(title):
             continue
         if only_has_doc_url and not doc_url:
             continue
-        if isinstance(published, datetime) and published < cutoff_utc:
+        if published is not None and published < cutoff_utc:
             continue
-        out.append(it)
+        out.append(i)
     return out
 
 
-filtered = apply_filters(only_kessan)
+idx = apply_filters(only_kessan)
 
 # 0件なら自動で広めにする
-if only_kessan and not filtered:
+if only_kessan and not idx:
     st.info("『決算短信だけ』で0件だったので、フィルタを広げて表示します。")
-    filtered = apply_filters(False)
+    idx = apply_filters(False)
+
+filtered = [normalized[i] for i in idx]
 
 st.subheader(f"候補：{len(filtered)}件")
 if not filtered:
@@ -385,7 +320,7 @@ for i, it in enumerate(filtered[:show_n]):
 
     # 一意キー（URLベース + index）
     seed = f"{doc_url}|{published_str}|{title}|{i}"
-    uid = hashlib.md5(seed.encode("utf-8")).hexdigest()[:12]
+    uid = hashlib.blake2b(seed.encode("utf-8"), digest_size=6).hexdigest()
 
     # 会社名があればコード横に出す
     name_part = f" {company_name}" if company_name else ""
@@ -414,14 +349,14 @@ for i, it in enumerate(filtered[:show_n]):
         run = st.button("AI分析", key=f"ai_{uid}", disabled=not can_run_ai)
 
         if run:
-            if not _check_pdf_size_or_warn(doc_url, max_pdf_bytes):
-                st.stop()
-
             with st.spinner("AIが決算短信を解析中..."):
                 try:
-                    payload = analyze_pdf_to_json(doc_url)
-                    save_analysis(DB_PATH, doc_url, code_, title, published, payload)
-                    st.success("解析完了")
+                    # サイズ上限は analyzer 側のGETで判定（HEADの往復を省く）
+                    payload = analyze_pdf_to_json(doc_url, max_pdf_bytes=max_pdf_bytes or None, db_path=DB_PATH)
+                    # 失敗（サイズ超過など）はキャッシュしない
+                    if payload.get("ok") is not False:
+                        save_analysis(DB_PATH, doc_url, code_, title, published, payload)
+                        st.success("解析完了")
                     render_analysis(payload)
                 except Exception as e:
                     st.error(f"解析エラー: {type(e).__name__}: {e}")
@@ -451,9 +386,6 @@ if manual:
     _safe_pdf_link(manual)
 
 if manual_run:
-    if not _check_pdf_size_or_warn(manual, max_pdf_bytes):
-        st.stop()
-
     cached = get_cached_analysis(DB_PATH, manual)
     if cached:
         st.success("解析済み（キャッシュ）")
@@ -461,10 +393,11 @@ if manual_run:
     else:
         with st.spinner("AIが解析中..."):
             try:
-                payload = analyze_pdf_to_json(manual)
-                # 手動はコード等が分からないので空で保存（URLキャッシュとして十分）
-                save_analysis(DB_PATH, manual, "", "manual", None, payload)
-                st.success("解析完了")
+                payload = analyze_pdf_to_json(manual, max_pdf_bytes=max_pdf_bytes or None, db_path=DB_PATH)
+                if payload.get("ok") is not False:
+                    # 手動はコード等が分からないので空で保存（URLキャッシュとして十分）
+                    save_analysis(DB_PATH, manual, "", "manual", None, payload)
+                    st.success("解析完了")
                 render_analysis(payload)
             except Exception as e:
                 st.error(f"解析エラー: {type(e).__name__}: {e}")
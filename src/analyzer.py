@@ -1,12 +1,24 @@
 from __future__ import annotations
 
+import functools
+import hashlib
+import io
 import json
 import os
+import random
+import re
+import tempfile
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Any, Optional, Tuple
+from typing import IO, Any, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from src.storage import get_text_cache, save_text_cache
 
 # PDF抽出（requirements: pypdf）
 try:
@@ -17,16 +29,43 @@ except Exception:
 # Gemini SDK（requirements: google-genai）
 try:
     from google import genai
+    from google.genai import errors as genai_errors
 except Exception:
     genai = None  # type: ignore
+    genai_errors = None  # type: ignore
+
+# 通信エラーの判定用（httpx は google-genai の依存として入る）
+try:
+    import httpx
+except Exception:
+    httpx = None  # type: ignore
+
+# 出力スキーマ（pydantic は google-genai の依存として入る）
+try:
+    from pydantic import BaseModel
+except Exception:
+    BaseModel = None  # type: ignore
+
+
+# ENV由来の既定値（rerun毎に読み直さないよう import 時に1回だけ評価）
+_DEFAULT_MODEL = (os.getenv("GEMINI_MODEL") or "gemini-2.0-flash").strip()
+try:
+    _DEFAULT_MAX_PDF_BYTES = int(os.getenv("MAX_PDF_BYTES") or 0)
+except ValueError:
+    # 壊れた値で app の import ごと落とさない
+    _DEFAULT_MAX_PDF_BYTES = 0
+if _DEFAULT_MAX_PDF_BYTES <= 0:
+    # 無指定時の安全なデフォルト（20MB）
+    _DEFAULT_MAX_PDF_BYTES = 20 * 1024 * 1024
 
 
 # ----------------------------
 # Public API (used by app.py)
 # ----------------------------
 
+@functools.lru_cache(maxsize=1)
 def ai_is_enabled() -> bool:
-    """Gemini APIキーが設定されているか（Secrets/ENV両対応想定）"""
+    """Gemini APIキーが設定されているか（Secrets/ENV両対応想定）。プロセス内で1回だけ判定する。"""
     key = (os.getenv("GEMINI_API_KEY") or "").strip()
     return bool(key)
 
@@ -37,23 +76,26 @@ def analyze_pdf_to_json(
     gemini_api_key: Optional[str] = None,
     gemini_model: Optional[str] = None,
     max_pdf_bytes: Optional[int] = None,
+    db_path: Optional[str] = None,
 ) -> dict[str, Any]:
     """
     app.py から呼ばれる想定。
-    決算短信PDFをDL→テキスト抽出→GeminiでJSON要約→dictで返す。
+    決算短信PDFをDL→GeminiにPDFごと渡してJSON要約→dictで返す
+    （inlineで送れない大きさのPDFだけテキスト抽出して渡す）。
+    db_path を渡すと、PDF本文のハッシュ単位で抽出テキスト/解析結果をキャッシュする。
     """
     key = (gemini_api_key or os.getenv("GEMINI_API_KEY") or "").strip()
-    model = (gemini_model or os.getenv("GEMINI_MODEL") or "gemini-2.0-flash").strip()
-    limit = int(max_pdf_bytes or (os.getenv("MAX_PDF_BYTES") or 0) or 0)
+    model = (gemini_model or "").strip() or _DEFAULT_MODEL
+    limit = int(max_pdf_bytes or 0)
     if limit <= 0:
-        # 無指定時の安全なデフォルト（20MB）
-        limit = 20 * 1024 * 1024
+        limit = _DEFAULT_MAX_PDF_BYTES
 
     res = summarize_kessan_pdf_to_json(
         pdf_url=pdf_url,
         gemini_api_key=key,
         gemini_model=model,
         max_pdf_bytes=limit,
+        db_path=db_path,
     )
 
     if not res.ok:
@@ -80,20 +122,73 @@ class AnalyzeResult:
     payload: Optional[dict[str, Any]] = None
 
 
+# ----------------------------
+# Gemini response schema
+# ----------------------------
+# プロンプトに手書きJSONスキーマを埋め込む代わりに response_schema で渡す
+# （サーバ側で形が強制され、プロンプトのトークンも減る）。
+# 値が無ければ null を返させたいので、全項目 Optional・デフォルト無し（=必須キー）。
+
+if BaseModel is not None:
+
+    class _Figures(BaseModel):
+        sales: Optional[float]
+        op_profit: Optional[float]
+        ordinary_profit: Optional[float]
+        net_profit: Optional[float]
+
+    class _Revision(BaseModel):
+        exists: Optional[bool]
+        direction: Optional[str]
+        reason: Optional[str]
+
+    class _Performance(_Figures):
+        yoy: _Figures
+        progress_full_year: _Figures
+        revision: _Revision
+
+    class _Guidance(BaseModel):
+        full_year_forecast: _Figures
+        assumptions: list[str]
+        notes: Optional[str]
+
+    class KessanSchema(BaseModel):
+        summary: str
+        performance: _Performance
+        guidance: _Guidance
+        highlights: list[str]
+        risks: list[str]
+        next_to_check: list[str]
+
+else:
+    KessanSchema = None  # type: ignore
+
+
 # ----------------------------
 # PDF: download + extract
 # ----------------------------
 
-def download_pdf(url: str, max_bytes: int) -> tuple[bytes | None, str]:
+# PDF取得用（keep-aliveで連続解析時のTLSハンドシェイクを省く）
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+# 2MBまではメモリ、それを超えたら一時ファイルに逃がす（ピークメモリを抑える）
+_PDF_SPOOL_MAX = 2 * 1024 * 1024
+
+
+def download_pdf(url: str, max_bytes: int) -> tuple[IO[bytes] | None, str, str]:
     """
     PDFをダウンロード。サイズ上限を超えたら止める。
+    返り値: (file, sha256_hex, err)
+    file は先頭にseek済み。使い終わったら close すること。
     """
     u = (url or "").strip()
     if not u:
-        return None, "PDF URLが空です。"
+        return None, "", "PDF URLが空です。"
 
+    buf = tempfile.SpooledTemporaryFile(max_size=_PDF_SPOOL_MAX)
     try:
-        with requests.get(
+        with _SESSION.get(
             u,
             stream=True,
             timeout=35,
@@ -101,33 +196,41 @@ def download_pdf(url: str, max_bytes: int) -> tuple[bytes | None, str]:
         ) as r:
             r.raise_for_status()
 
-            total = 0
-            chunks: list[bytes] = []
+            # Content-Length が分かれば本文を読む前に弾く（HEADの往復を省く）
+            cl = r.headers.get("Content-Length")
+            if cl and cl.isdigit() and int(cl) > max_bytes:
+                buf.close()
+                return None, "", f"PDFサイズが上限を超えています：{int(cl)/1024/1024:.1f}MB > {max_bytes/1024/1024:.1f}MB"
 
+            total = 0
+            h = hashlib.sha256()
             for chunk in r.iter_content(chunk_size=1024 * 128):
                 if not chunk:
                     continue
                 total += len(chunk)
                 if total > max_bytes:
-                    return None, f"PDFサイズが上限を超えました（>{max_bytes} bytes）"
-                chunks.append(chunk)
+                    buf.close()
+                    return None, "", f"PDFサイズが上限を超えました（>{max_bytes} bytes）"
+                h.update(chunk)
+                buf.write(chunk)
 
-            return b"".join(chunks), ""
+        buf.seek(0)
+        return buf, h.hexdigest(), ""
     except Exception as e:
-        return None, f"PDFダウンロード失敗: {e}"
+        buf.close()
+        return None, "", f"PDFダウンロード失敗: {e}"
 
 
-def extract_text_from_pdf_bytes(pdf_bytes: bytes, max_pages: int = 35) -> tuple[str, str]:
+def extract_text_from_pdf_bytes(pdf: IO[bytes] | bytes, max_pages: int = 35) -> tuple[str, str]:
     """
+    pdf はファイルライクオブジェクト（download_pdf の返り値）か bytes。
     返り値: (text, err)
     """
     if PdfReader is None:
         return "", "PDF抽出ライブラリ(pypdf)が未インストールです。requirements に `pypdf` を追加してください。"
 
     try:
-        import io
-
-        reader = PdfReader(io.BytesIO(pdf_bytes))
+        reader = PdfReader(io.BytesIO(pdf) if isinstance(pdf, (bytes, bytearray)) else pdf)
 
         # 暗号化PDF対策（パス無しで開けるケースだけ try）
         try:
@@ -151,21 +254,99 @@ def extract_text_from_pdf_bytes(pdf_bytes: bytes, max_pages: int = 35) -> tuple[
         return "", f"PDF抽出に失敗しました: {e}"
 
 
+# プロンプトに入れる抽出テキストの上限（文字数）
+_PROMPT_TEXT_MAX = 60000
+
+
+# 抽出テキストのプロセス内キャッシュ（sha256 → text）。
+# Gemini失敗→再実行のときに pypdf をやり直さない（DBキャッシュ無しでも効く）。
+_TEXT_MEMO: OrderedDict[str, str] = OrderedDict()
+_TEXT_MEMO_MAX = 64
+_TEXT_MEMO_LOCK = threading.Lock()
+
+
+def _text_memo_get(sha256: str) -> Optional[str]:
+    with _TEXT_MEMO_LOCK:
+        text = _TEXT_MEMO.get(sha256)
+        if text is not None:
+            _TEXT_MEMO.move_to_end(sha256)
+        return text
+
+
+def _text_memo_put(sha256: str, text: str) -> None:
+    with _TEXT_MEMO_LOCK:
+        _TEXT_MEMO[sha256] = text
+        _TEXT_MEMO.move_to_end(sha256)
+        while len(_TEXT_MEMO) > _TEXT_MEMO_MAX:
+            _TEXT_MEMO.popitem(last=False)
+
+
 # ----------------------------
 # Gemini: generate JSON
 # ----------------------------
 
+# ```json ... ``` の前後フェンスを1パスで剥がす
+_JSON_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$", re.IGNORECASE)
+
+
+# リトライする価値があるHTTPステータス（レート制限/一時障害）
+_RETRYABLE_STATUS = frozenset({429, 500, 502, 503, 504})
+
+
+# タイムアウト/接続断など、投げ直せば通りうる通信エラー
+_TRANSPORT_ERRORS: tuple[type[BaseException], ...] = (TimeoutError, ConnectionError)
+if httpx is not None:
+    _TRANSPORT_ERRORS += (httpx.TransportError,)
+
+
+def _is_retryable(e: Exception) -> bool:
+    """
+    API側のエラーはステータス（429/5xx）で判定し、それ以外は通信エラーだけリトライする。
+    引数/設定の誤り（ValueError/TypeError 等）は何度やっても同じなので即返す。
+    """
+    if genai_errors is not None and isinstance(e, genai_errors.APIError):
+        return getattr(e, "code", None) in _RETRYABLE_STATUS
+    return isinstance(e, _TRANSPORT_ERRORS)
+
+
+@functools.lru_cache(maxsize=4)
+def _client(api_key: str) -> Any:
+    """
+    APIキーごとに genai.Client を使い回す（接続/認証の準備を毎回やらない）。
+    キーで引くので Secrets のキー差し替えにも追従する。
+    """
+    return genai.Client(api_key=api_key)
+
+
+def _get_client(api_key: str) -> Any:
+    """
+    キー無し/SDK無し/生成失敗は None（エラー文言は呼び出し側で出す）。
+    """
+    api_key = (api_key or "").strip()
+    if not api_key or genai is None:
+        return None
+    try:
+        return _client(api_key)
+    except Exception:
+        return None
+
+
 def _gemini_generate_json(
     api_key: str,
     model: str,
-    prompt: str,
+    contents: Any,
     *,
+    client: Any = None,
+    response_schema: Any = None,
     temperature: float = 0.2,
     max_retries: int = 3,
     retry_sleep: float = 1.2,
 ) -> Tuple[Optional[dict[str, Any]], Optional[int], str]:
     """
     google-genai SDKで application/json を返させる。
+    contents はプロンプト文字列、または [PDFパート, プロンプト] のリスト。
+    client を渡せばそれを使う（無ければここで作る）。
+    response_schema を渡すと出力の形をサーバ側で強制する。
     返り値: (json_dict, tokens, err)
     """
     api_key = (api_key or "").strip()
@@ -177,19 +358,24 @@ def _gemini_generate_json(
     model = (model or "").strip() or "gemini-2.0-flash"
 
     # SDKクライアント
-    client = genai.Client(api_key=api_key)
+    if client is None:
+        client = _client(api_key)
+
+    config: dict[str, Any] = {
+        "temperature": float(temperature),
+        # JSONで返させる（重要）
+        "response_mime_type": "application/json",
+    }
+    if response_schema is not None:
+        config["response_schema"] = response_schema
 
     last_err = ""
     for attempt in range(1, max_retries + 1):
         try:
             resp = client.models.generate_content(
                 model=model,
-                contents=prompt,
-                config={
-                    "temperature": float(temperature),
-                    # JSONで返させる（重要）
-                    "response_mime_type": "application/json",
-                },
+                contents=contents,
+                config=config,
             )
 
             # google-genaiの返却は resp.text に JSON文字列が入ることが多い
@@ -202,8 +388,7 @@ def _gemini_generate_json(
                 obj = json.loads(raw)
             except Exception:
                 # たまに ```json ... ``` で返すモデルがあるので救済
-                cleaned = raw.strip().strip("`")
-                cleaned = cleaned.replace("json\n", "", 1) if cleaned.lower().startswith("json\n") else cleaned
+                cleaned = _JSON_FENCE_RE.sub("", raw)
                 try:
                     obj = json.loads(cleaned)
                 except Exception:
@@ -220,9 +405,12 @@ def _gemini_generate_json(
 
         except Exception as e:
             last_err = str(e)
-            # 軽いリトライ（429/503などを想定）
+            # 400/401/403/404 などは何度やっても同じなので即返す
+            if not _is_retryable(e):
+                break
+            # 429/5xx/通信エラーはジッター付き指数バックオフでリトライ
             if attempt < max_retries:
-                time.sleep(retry_sleep * attempt)
+                time.sleep(retry_sleep * (2 ** (attempt - 1)) * random.uniform(0.8, 1.2))
                 continue
             break
 
@@ -233,85 +421,111 @@ def _gemini_generate_json(
 # Main summarizer
 # ----------------------------
 
-def summarize_kessan_pdf_to_json(
-    pdf_url: str,
-    gemini_api_key: str,
-    gemini_model: str,
-    max_pdf_bytes: int,
-) -> AnalyzeResult:
-    pdf_bytes, err = download_pdf(pdf_url, max_bytes=max_pdf_bytes)
-    if pdf_bytes is None:
-        return AnalyzeResult(ok=False, error=err)
+# プロンプト/出力スキーマを変えたら上げる（古い版で作った payload キャッシュを使わないため）
+_PROMPT_VERSION = 2
 
-    text, err = extract_text_from_pdf_bytes(pdf_bytes, max_pages=35)
-    if err:
-        return AnalyzeResult(ok=False, error=err)
+# これ以下のPDFはGeminiにそのまま渡す（inlineリクエストは全体で20MBまで。base64で約4/3倍になる）
+_INLINE_PDF_MAX = 14 * 1024 * 1024
 
-    # 入れすぎると遅い・コスト増なので上限を設ける（必要なら調整）
-    text = text[:160000]
+
+def _build_prompt(text: Optional[str] = None) -> str:
+    """
+    text 無しは PDF を直接添付する場合、有りは抽出テキストを埋め込む場合。
+    """
+    if text is None:
+        source = "添付はTDnetの決算短信PDFです。"
+    else:
+        source = "以下はTDnetの決算短信PDFから抽出したテキストです。"
 
     prompt = f"""
 あなたは日本株の決算短信を読むプロのアナリストです。
-以下はTDnetの決算短信PDFから抽出したテキストです。
-投資判断に使えるように「必ずJSONのみ」で整理してください。
+{source}
+投資判断に使えるように、指定のJSONスキーマで整理してください。
 
 【出力ルール】
-- 出力は JSON オブジェクトのみ（説明文やMarkdown禁止）
 - 文字列は日本語
+- summary は3行以内
 - 数値は可能なら number（不明なら null）
+- yoy は前年同期比（%）、progress_full_year は通期予想に対する進捗（%）
 - YOY/進捗/修正など、見つかったものだけ埋める（不明は null）
 - 文章は短く、箇条書きは配列にする
-
-【JSONスキーマ（厳守）】
-{{
-  "ok": true,
-  "summary": "3行以内",
-  "performance": {{
-    "sales": null,
-    "op_profit": null,
-    "ordinary_profit": null,
-    "net_profit": null,
-    "yoy": {{
-      "sales": null,
-      "op_profit": null,
-      "ordinary_profit": null,
-      "net_profit": null
-    }},
-    "progress_full_year": {{
-      "sales": null,
-      "op_profit": null,
-      "ordinary_profit": null,
-      "net_profit": null
-    }},
-    "revision": {{
-      "exists": null,
-      "direction": null,
-      "reason": null
-    }}
-  }},
-  "guidance": {{
-    "full_year_forecast": {{
-      "sales": null,
-      "op_profit": null,
-      "ordinary_profit": null,
-      "net_profit": null
-    }},
-    "assumptions": ["..."],
-    "notes": "..."
-  }},
-  "highlights": ["..."],
-  "risks": ["..."],
-  "next_to_check": ["..."]
-}}
-
-【テキスト】
-{text}
 """.strip()
 
+    if text is not None:
+        prompt += f"\n\n【テキスト】\n{text}"
+    return prompt
+
+
+def summarize_kessan_pdf_to_json(
+    pdf_url: str,
+    gemini_api_key: str,
+    gemini_model: str,
+    max_pdf_bytes: int,
+    db_path: Optional[str] = None,
+) -> AnalyzeResult:
+    pdf_file, sha256, err = download_pdf(pdf_url, max_bytes=max_pdf_bytes)
+    if pdf_file is None:
+        return AnalyzeResult(ok=False, error=err)
+
+    # 同じPDF（URL違い/再アップ含む）を同じモデル・同じプロンプト版で解析済みならGeminiを呼ばずに返す
+    cached_text, cached_payload = get_text_cache(db_path, sha256) if db_path else (None, None)
+    if (
+        cached_payload is not None
+        and cached_payload.get("model") == gemini_model
+        and cached_payload.get("prompt_version") == _PROMPT_VERSION
+    ):
+        pdf_file.close()
+        payload = dict(cached_payload)
+        payload["pdf_url"] = pdf_url
+        return AnalyzeResult(ok=True, payload=payload, tokens=payload.get("tokens"))
+
+    pdf_size = pdf_file.seek(0, io.SEEK_END)
+    pdf_file.seek(0)
+
+    contents: Any
+    if genai is not None and pdf_size <= _INLINE_PDF_MAX:
+        # PDFをそのままGeminiに渡す（pypdfでのテキスト抽出を丸ごと省く）
+        with pdf_file:
+            pdf_bytes = pdf_file.read()
+        contents = [
+            genai.types.Part.from_bytes(data=pdf_bytes, mime_type="application/pdf"),
+            _build_prompt(),
+        ]
+        client = _get_client(gemini_api_key)
+    else:
+        # inline で送れない大きさのPDFはテキスト抽出にフォールバック
+        if not cached_text:
+            cached_text = _text_memo_get(sha256)
+        if cached_text:
+            pdf_file.close()
+            text = cached_text
+            client = _get_client(gemini_api_key)
+        else:
+            # pypdfの抽出（CPU）を別スレッドで走らせ、その間にGeminiクライアントを準備する
+            with pdf_file, ThreadPoolExecutor(max_workers=1) as ex:
+                fut = ex.submit(extract_text_from_pdf_bytes, pdf_file, 35)
+                client = _get_client(gemini_api_key)
+                text, err = fut.result()
+            if err:
+                return AnalyzeResult(ok=False, error=err)
+            _text_memo_put(sha256, text)
+            if db_path:
+                # キャッシュは best-effort（DBロック/読み取り専用などで解析自体を落とさない）
+                try:
+                    save_text_cache(db_path, sha256, text=text)
+                except Exception:
+                    pass
+
+        # 入れすぎると遅い・コスト増なので上限を設ける（必要なら調整）
+        # 決算短信の要点（サマリー情報・経営成績）は冒頭に集まっている
+        contents = _build_prompt(text[:_PROMPT_TEXT_MAX])
+
     obj, tokens, err = _gemini_generate_json(
         api_key=gemini_api_key,
         model=gemini_model,
-        prompt=prompt,
+        contents=contents,
+        client=client,
+        response_schema=KessanSchema,
         temperature=0.2,
         max_retries=3,
     )
@@ -323,7 +537,14 @@ def summarize_kessan_pdf_to_json(
         "ok": True,
         "pdf_url": pdf_url,
         "model": gemini_model,
+        "prompt_version": _PROMPT_VERSION,
         "tokens": tokens,
         "result": obj,
     }
+    if db_path:
+        # Gemini は成功しているので、キャッシュ保存に失敗しても結果は返す
+        try:
+            save_text_cache(db_path, sha256, payload=payload)
+        except Exception:
+            pass
     return AnalyzeResult(ok=True, payload=payload, tokens=tokens)
@@ -1,10 +1,19 @@
 from __future__ import annotations
 
+import functools
 import json
 import os
 import sqlite3
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
-from typing import Optional
+from typing import Any, Iterator, Optional
+
+# JSON（requirements: orjson。無ければ標準jsonで動く）
+try:
+    import orjson
+except Exception:
+    orjson = None  # type: ignore
 
 _JST = timezone(timedelta(hours=9))
 
@@ -13,20 +22,102 @@ def db_path_default() -> str:
     return "/tmp/app.db"
 
 
+def _dumps(obj: Any) -> bytes:
+    """UTF-8 の JSON bytes（payload_blob にそのまま入れる）。"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass  # 非strキー等は標準jsonに任せる
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def _loads(raw: str | bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+# db_path ごとにプロセス内で接続を1本だけ持ち回す（毎回の connect + PRAGMA を省く）。
+# Streamlit はセッションごとにスレッドが違うので、共有接続の利用は _LOCK で直列化する。
+_CONN_CACHE: dict[str, sqlite3.Connection] = {}
+_LOCK = threading.RLock()
+
+
 def _connect(db_path: str) -> sqlite3.Connection:
-    con = sqlite3.connect(db_path, timeout=30)
-    con.execute("PRAGMA journal_mode=WAL;")
-    con.execute("PRAGMA synchronous=NORMAL;")
-    return con
+    with _LOCK:
+        con = _CONN_CACHE.get(db_path)
+        if con is not None:
+            return con
+
+        # isolation_level=None: 暗黙のトランザクションを使わず、書き込みは _transaction で明示する
+        con = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        con.execute("PRAGMA busy_timeout=30000;")  # ロック待ちはSQLite側で（30秒）
+        con.execute("PRAGMA journal_mode=WAL;")
+        con.execute("PRAGMA synchronous=NORMAL;")
+        con.execute("PRAGMA temp_store=MEMORY;")
+        con.execute("PRAGMA mmap_size=268435456;")  # 256MiB
+        con.execute("PRAGMA cache_size=-65536;")  # 64MiB
+        _CONN_CACHE[db_path] = con
+        return con
+
+
+def close_all() -> None:
+    """
+    キャッシュ中の接続を全部閉じる（最後の接続が閉じると SQLite が -wal/-shm を片付ける）。
+    テストの後始末やDBファイルを差し替える前に呼ぶ。
+    """
+    with _LOCK:
+        for con in _CONN_CACHE.values():
+            try:
+                con.close()
+            except Exception:
+                pass
+        _CONN_CACHE.clear()
+    # DBファイルを作り直しても古い行を返さないよう、行キャッシュも捨てる
+    _get_cached_raw.cache_clear()
+
+
+@contextmanager
+def _transaction(db_path: str) -> Iterator[sqlite3.Cursor]:
+    """
+    書き込み用。BEGIN IMMEDIATE 〜 COMMIT（例外なら ROLLBACK）。
+    """
+    con = _connect(db_path)
+    with _LOCK:
+        cur = con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            yield cur
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+        cur.execute("COMMIT")
+
+
+# スキーマ（テーブル/列/索引/payload_blob 移行）を変えたら上げる。PRAGMA user_version に記録する。
+_SCHEMA_VERSION = 1
 
 
 def init_db(db_path: str) -> None:
+    """
+    app.py は rerun のたびに呼ぶので、移行済みなら user_version を読むだけで返す
+    （書き込みロックも DDL/UPDATE も取らない）。
+    """
     if "/" in db_path:
         os.makedirs(os.path.dirname(db_path), exist_ok=True)
 
     con = _connect(db_path)
-    cur = con.cursor()
+    with _LOCK:
+        if con.execute("PRAGMA user_version").fetchone()[0] >= _SCHEMA_VERSION:
+            return
+
+    with _transaction(db_path) as cur:
+        _create_tables(cur)
+        cur.execute(f"PRAGMA user_version={_SCHEMA_VERSION}")
+
 
+def _create_tables(cur: sqlite3.Cursor) -> None:
     cur.execute(
         """
         CREATE TABLE IF NOT EXISTS analyses (
@@ -48,10 +139,33 @@ def init_db(db_path: str) -> None:
     _ensure_column(cur, "analyses", "code4", "TEXT")
     _ensure_column(cur, "analyses", "published_date_jst", "TEXT")
     _ensure_column(cur, "analyses", "doc_type", "TEXT")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_analyses_code4_date ON analyses(code4, published_date_jst)")
 
-    con.commit()
-    con.close()
+    # payload はJSONの bytes で持つ（TEXTだと書き込み時のUTF-8検証と読み出し時のdecodeが挟まる）。
+    # 既存行の payload_json はここで payload_blob へ移す（UTF-8 DBなので CAST でそのまま bytes になる）。
+    _ensure_column(cur, "analyses", "payload_blob", "BLOB")
+    cur.execute(
+        "UPDATE analyses SET payload_blob = CAST(payload_json AS BLOB) "
+        "WHERE payload_blob IS NULL AND payload_json IS NOT NULL"
+    )
+    # 銘柄×日付の一覧/件数は索引だけで返せるよう doc_type, doc_url まで含める（カバリングインデックス）。
+    # 先頭2列が同じ旧インデックスは不要なので落とす。
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_analyses_code4_date_doctype "
+        "ON analyses(code4, published_date_jst, doc_type, doc_url)"
+    )
+    cur.execute("DROP INDEX IF EXISTS idx_analyses_code4_date")
+
+    # PDF本文のハッシュ（sha256）単位のキャッシュ：URLが違っても同じPDFなら再抽出/再解析しない
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS text_cache (
+          sha256 TEXT PRIMARY KEY,
+          text TEXT,
+          payload BLOB,
+          created_at TEXT
+        )
+        """
+    )
 
 
 def _ensure_column(cur: sqlite3.Cursor, table: str, col: str, coltype: str) -> None:
@@ -62,37 +176,61 @@ def _ensure_column(cur: sqlite3.Cursor, table: str, col: str, coltype: str) -> N
     cur.execute(f"ALTER TABLE {table} ADD COLUMN {col} {coltype}")
 
 
+class _Miss(Exception):
+    """_get_cached_raw で行が無いとき用（例外は lru_cache に残らないので、未保存はキャッシュされない）。"""
+
+
+# 保存のたびに進める世代番号。読み込み側はSELECTの前に読んでキーに含めるので、
+# 保存と競合して読んだ古い行は、以後引かれない世代のキーにしか残らない。
+_CACHE_GEN = 0
+
+
+@functools.lru_cache(maxsize=512)
+def _get_cached_raw(db_path: str, doc_url: str, gen: int) -> tuple:
+    """
+    (payload bytes/str, model, tokens, schema_version, code4, published_date_jst, doc_type) を返す。
+    行が無ければ _Miss。
+    Streamlit の再実行で同じ doc_url が何度も来るのでプロセス内でキャッシュする。
+    中身は不変なので共有してよい（dict へのパースは呼び出し側で毎回行う）。
+    """
+    con = _connect(db_path)
+
+    with _LOCK:
+        cur = con.cursor()
+        try:
+            cur.execute(
+                """
+                SELECT COALESCE(payload_blob, payload_json), model, tokens, schema_version,
+                       code4, published_date_jst, doc_type
+                FROM analyses WHERE doc_url=?
+                """,
+                (doc_url,),
+            )
+            row = cur.fetchone()
+        except Exception:
+            # 古いDB用（init_db 前で列が無い）
+            cur.execute("SELECT payload_json FROM analyses WHERE doc_url=?", (doc_url,))
+            row = cur.fetchone()
+            if row:
+                row = (row[0], None, None, None, None, None, None)
+
+    if not row:
+        raise _Miss(doc_url)
+    return tuple(row)
+
+
 def get_cached_analysis(db_path: str, doc_url: str) -> dict | None:
     if not doc_url:
         return None
 
-    con = _connect(db_path)
-    cur = con.cursor()
-
     try:
-        cur.execute(
-            """
-            SELECT payload_json, model, tokens, schema_version, code4, published_date_jst, doc_type
-            FROM analyses WHERE doc_url=?
-            """,
-            (doc_url,),
-        )
-        row = cur.fetchone()
-        con.close()
-        if not row:
-            return None
-        payload_raw, model, tokens, schema_version, code4, date_jst, doc_type = row
-    except Exception:
-        cur.execute("SELECT payload_json FROM analyses WHERE doc_url=?", (doc_url,))
-        row = cur.fetchone()
-        con.close()
-        if not row:
-            return None
-        payload_raw = row[0]
-        model = tokens = schema_version = code4 = date_jst = doc_type = None
+        row = _get_cached_raw(db_path, doc_url, _CACHE_GEN)
+    except _Miss:
+        return None
+    payload_raw, model, tokens, schema_version, code4, date_jst, doc_type = row
 
     try:
-        payload = json.loads(payload_raw)
+        payload = _loads(payload_raw)
         if isinstance(payload, dict):
             if model and "model" not in payload:
                 payload["model"] = model
@@ -120,9 +258,59 @@ def save_analysis(
     published_at,
     payload: dict,
 ) -> None:
-    if not doc_url:
+    save_analyses_bulk(db_path, [(doc_url, code, title, published_at, payload)])
+
+
+def save_analyses_bulk(db_path: str, items: list[tuple]) -> None:
+    """
+    items: [(doc_url, code, title, published_at, payload), ...]
+    まとめて1トランザクションで保存する（件数分のCOMMITを避ける）。doc_url 空は飛ばす。
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    rows = [_analysis_row(*it, created_at=now) for it in items if it[0]]
+    if not rows:
         return
 
+    try:
+        with _transaction(db_path) as cur:
+            try:
+                cur.executemany(
+                    """
+                    INSERT OR REPLACE INTO analyses
+                      (doc_url, code, title, published_at, payload_blob, created_at,
+                       model, tokens, schema_version,
+                       code4, published_date_jst, doc_type)
+                    VALUES (?,?,?,?,?,?,?,?,?,?,?,?)
+                    """,
+                    rows,
+                )
+            except Exception:
+                # 古いDB用フォールバック（先頭6列は同じ並び。payload は TEXT 列に入れる）
+                cur.executemany(
+                    """
+                    INSERT OR REPLACE INTO analyses
+                      (doc_url, code, title, published_at, payload_json, created_at)
+                    VALUES (?,?,?,?,?,?)
+                    """,
+                    [(r[0], r[1], r[2], r[3], r[4].decode("utf-8"), r[5]) for r in rows],
+                )
+    finally:
+        # 書き込み後に世代を進める（古い世代のキーは以後引かれない）。メモリは cache_clear で返す
+        global _CACHE_GEN
+        with _LOCK:
+            _CACHE_GEN += 1
+        _get_cached_raw.cache_clear()
+
+
+def _analysis_row(
+    doc_url: str,
+    code: str,
+    title: str,
+    published_at,
+    payload: dict,
+    *,
+    created_at: str,
+) -> tuple:
     published_str = ""
     date_jst = ""
     if published_at is not None:
@@ -133,84 +321,109 @@ def save_analysis(
             published_str = str(published_at)
 
     code4 = (code or "").strip()[:4] if (code or "").strip() else ""
-    model = _infer_model(payload)
-    tokens = _infer_tokens(payload)
-    schema_version = _infer_schema_version(payload)
-    doc_type = _infer_doc_type(title)
+    model, tokens, schema_version, doc_type = _extract_meta(title, payload)
+    return (
+        doc_url,
+        code,
+        title,
+        published_str,
+        _dumps(payload),
+        created_at,
+        model,
+        tokens,
+        schema_version,
+        code4,
+        date_jst,
+        doc_type,
+    )
+
+
+def get_text_cache(db_path: str, sha256: str) -> tuple[Optional[str], Optional[dict]]:
+    """
+    PDFハッシュで (抽出テキスト, 解析payload) を引く。無い方は None。
+    """
+    if not sha256:
+        return None, None
 
     con = _connect(db_path)
-    cur = con.cursor()
+    with _LOCK:
+        try:
+            row = con.execute("SELECT text, payload FROM text_cache WHERE sha256=?", (sha256,)).fetchone()
+        except Exception:
+            row = None
+    if not row:
+        return None, None
 
-    try:
-        cur.execute(
-            """
-            INSERT OR REPLACE INTO analyses
-              (doc_url, code, title, published_at, payload_json, created_at,
-               model, tokens, schema_version,
-               code4, published_date_jst, doc_type)
-            VALUES (?,?,?,?,?,?,?,?,?,?,?,?)
-            """,
-            (
-                doc_url,
-                code,
-                title,
-                published_str,
-                json.dumps(payload, ensure_ascii=False),
-                datetime.now(timezone.utc).isoformat(),
-                model,
-                tokens,
-                schema_version,
-                code4,
-                date_jst,
-                doc_type,
-            ),
-        )
-    except Exception:
-        # 古いDB用フォールバック
+    text, payload_raw = row
+    payload = None
+    if payload_raw:
+        try:
+            obj = _loads(payload_raw)
+            payload = obj if isinstance(obj, dict) else None
+        except Exception:
+            payload = None
+    return text or None, payload
+
+
+def save_text_cache(
+    db_path: str,
+    sha256: str,
+    *,
+    text: Optional[str] = None,
+    payload: Optional[dict] = None,
+) -> None:
+    """
+    text / payload のうち渡された方だけ更新する（既存の値は残す）。
+    """
+    if not sha256 or (text is None and payload is None):
+        return
+
+    payload_raw = _dumps(payload) if payload is not None else None
+
+    with _transaction(db_path) as cur:
         cur.execute(
             """
-            INSERT OR REPLACE INTO analyses
-              (doc_url, code, title, published_at, payload_json, created_at)
-            VALUES (?,?,?,?,?,?)
+            INSERT INTO text_cache (sha256, text, payload, created_at)
+            VALUES (?,?,?,?)
+            ON CONFLICT(sha256) DO UPDATE SET
+              text=COALESCE(excluded.text, text),
+              payload=COALESCE(excluded.payload, payload)
             """,
-            (
-                doc_url,
-                code,
-                title,
-                published_str,
-                json.dumps(payload, ensure_ascii=False),
-                datetime.now(timezone.utc).isoformat(),
-            ),
+            (sha256, text, payload_raw, datetime.now(timezone.utc).isoformat()),
         )
 
-    con.commit()
-    con.close()
 
+def _extract_meta(title: str, payload: dict) -> tuple:
+    """
+    payload を1回だけ見て (model, tokens, schema_version, doc_type) を返す。
+    """
+    doc_type = _infer_doc_type(title)
+    if not isinstance(payload, dict):
+        return None, None, None, doc_type
 
-def _infer_model(payload: dict) -> Optional[str]:
-    v = payload.get("model") if isinstance(payload, dict) else None
-    return str(v).strip() if v else None
-
+    g = payload.get
+    v = g("model")
+    model = str(v).strip() if v else None
 
-def _infer_tokens(payload: dict) -> Optional[int]:
-    v = payload.get("tokens") if isinstance(payload, dict) else None
+    v = g("tokens")
     if isinstance(v, int):
-        return v
-    if isinstance(v, str) and v.isdigit():
-        return int(v)
-    return None
-
+        tokens = v
+    elif isinstance(v, str) and v.isdigit():
+        tokens = int(v)
+    else:
+        tokens = None
 
-def _infer_schema_version(payload: dict) -> Optional[int]:
-    if not isinstance(payload, dict):
-        return None
-    if isinstance(payload.get("schema_version"), int):
-        return payload["schema_version"]
-    if isinstance(payload.get("result"), dict):
-        return 2
-    if any(k in payload for k in ("summary_1min", "headline", "watch_points")):
-        return 1
-    return None
+    v = g("schema_version")
+    if isinstance(v, int):
+        schema_version = v
+    elif isinstance(g("result"), dict):
+        schema_version = 2
+    elif "summary_1min" in payload or "headline" in payload or "watch_points" in payload:
+        schema_version = 1
+    else:
+        schema_version = None
+
+    return model, tokens, schema_version, doc_type
 
 
 def _infer_doc_type(title: str) -> str:
@@ -1,46 +1,106 @@
 from __future__ import annotations
 
+import functools
 import os
-import time
+import re
 from datetime import datetime, timedelta, timezone
 from typing import Any, Optional
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+# JSON（requirements: orjson。無ければ requests 標準の r.json()）
 try:
-    from zoneinfo import ZoneInfo
+    import orjson
 except Exception:
-    ZoneInfo = None  # type: ignore
+    orjson = None  # type: ignore
 
 # 非スクレイピングのJSONインデックス（やのしん TDnet WEB-API）
 TDNET_BASE = os.getenv("TDNET_BASE", "https://webapi.yanoshin.jp/webapi/tdnet/list")
 
 _JST = timezone(timedelta(hours=9))
-
-
-def _parse_dt_maybe(value: str | None) -> datetime | None:
+_UTC = timezone.utc
+
+# keep-aliveで銘柄切替/再取得時のTLSハンドシェイクを省く。
+# リトライは urllib3 に任せる（接続/読み取りエラーと 429/5xx。Retry-After も見る）
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=8,
+        max_retries=Retry(
+            total=2,
+            backoff_factor=0.8,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({"GET"}),
+            raise_on_status=False,
+        ),
+    ),
+)
+
+
+def _str(x: Any) -> str:
+    """既に str ならそのまま（str() を呼ばない）。"""
+    return x if type(x) is str else str(x)
+
+
+def parse_dt_utc(value: Any) -> datetime | None:
     """
     - ISO: 2026-02-06T20:00:00Z / +09:00
     - "YYYY-mm-dd HH:MM:SS"（tz無し）→ JST想定
-    返り値はUTC tz-aware datetime
+    - "YYYY/mm/dd HH:MM:SS"（tz無し）→ JST想定
+    返り値はUTC tz-aware datetime（app.py もこれを使うので、キャッシュは1つで共有される）
     """
     if not value:
         return None
-    s = str(value).strip()
+    s = _str(value).strip()
     if not s:
         return None
+    return _parse_dt_cached(s)
+
 
-    s = s.replace("Z", "+00:00")
+@functools.lru_cache(maxsize=4096)
+def _parse_dt_cached(s: str) -> datetime | None:
+    """
+    strip 済みの文字列をパース（同じ分の開示が多く、同じ文字列が何度も来るのでキャッシュ）。
+    datetime は不変なので共有して問題ない。
+    """
+    # よく来る "YYYY-mm-dd HH:MM:SS"（/ 区切りも。tz無し=JST）は切り出して直接組み立てる
+    # int() は符号/空白/全角数字も通すので、数字部分が ASCII の 0-9 だけのときに限る（それ以外は下の汎用パスへ）
+    if (
+        len(s) == 19
+        and s[4] in "-/"
+        and s[7] == s[4]
+        and s[10] in " T"
+        and s[13] == ":"
+        and s[16] == ":"
+        and (d := s[0:4] + s[5:7] + s[8:10] + s[11:13] + s[14:16] + s[17:19]).isascii()
+        and d.isdigit()
+    ):
+        try:
+            return datetime(
+                int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                int(s[11:13]), int(s[14:16]), int(s[17:19]),
+                tzinfo=_JST,
+            ).astimezone(_UTC)
+        except ValueError:
+            pass
+
+    # 末尾 Z だけ見る（全体を走査する replace は不要）
+    if s[-1:] == "Z":
+        s = s[:-1] + "+00:00"
+    # "YYYY/MM/DD ..." は日付の区切りだけ直して fromisoformat に通す（strptime は遅いので使わない）
+    if s[4:5] == "/":
+        s = s.replace("/", "-", 2)
 
     try:
         dt = datetime.fromisoformat(s)  # "YYYY-mm-dd HH:MM:SS" も通る
         if dt.tzinfo is None:
             # tz無しはJST想定（環境差でズレないよう固定で+09:00にする）
-            if ZoneInfo is not None:
-                dt = dt.replace(tzinfo=ZoneInfo("Asia/Tokyo"))
-            else:
-                dt = dt.replace(tzinfo=_JST)
-        return dt.astimezone(timezone.utc)
+            dt = dt.replace(tzinfo=_JST)
+        return dt.astimezone(_UTC)
     except Exception:
         return None
 
@@ -56,99 +116,132 @@ def _pick_tdnet_dict(raw: dict[str, Any]) -> dict[str, Any]:
     return raw
 
 
+# 全部数字で4桁以上 → 先頭4桁（5桁末尾0の 45230 -> 4523 もこれで同じ結果になる）
+_RE_CODE4 = re.compile(r"(\d{4})\d*")
+
+
 def _code4_from_company_code(company_code: str) -> str:
     """
     app.pyの _code4() と揃える：
     - 5桁末尾0: 45230 -> 4523
     - 4桁: 7203 -> 7203
-    - その他: 先頭4桁が数字なら採用
+    - その他: 全部数字で4桁以上なら先頭4桁
     """
-    s = (company_code or "").strip()
-    if not s.isdigit():
-        return ""
-    if len(s) == 5 and s.endswith("0"):
-        return s[:-1]
-    if len(s) >= 4:
-        return s[:4]
-    return ""
+    m = _RE_CODE4.fullmatch((company_code or "").strip())
+    return m.group(1) if m else ""
 
 
-def _normalize_item(raw: dict[str, Any]) -> dict[str, Any]:
-    td = _pick_tdnet_dict(raw)
+# TDnetレスポンスのキー揺れ（先に見つかった値を採用）
+_TITLE_KEYS = ("title", "Title")
+_CODE_KEYS = ("company_code", "CompanyCode", "code", "Code")
+_NAME_KEYS = ("company_name", "CompanyName")
+_URL_KEYS = ("document_url", "documentUrl", "doc_url", "url")
+_PUBLISHED_KEYS = ("published_at", "pubdate", "date")
 
-    title = td.get("title") or td.get("Title") or ""
-    company_code = (
-        td.get("company_code")
-        or td.get("CompanyCode")
-        or td.get("code")
-        or td.get("Code")
-        or ""
-    )
-    company_name = td.get("company_name") or td.get("CompanyName") or ""
-
-    # URLキーが揺れた場合に備える
-    doc_url = (
-        td.get("document_url")
-        or td.get("documentUrl")
-        or td.get("doc_url")
-        or td.get("url")
-        or ""
+
+def _first(d: dict[str, Any], keys: tuple[str, ...], default: Any = "") -> Any:
+    """keys を順に見て、最初の truthy な値を返す。"""
+    g = d.get
+    for k in keys:
+        v = g(k)
+        if v:
+            return v
+    return default
+
+
+# _fields() の並び（列指向版の列名にもそのまま使う）
+_FIELD_NAMES = ("title", "company_code", "code4", "company_name", "doc_url", "published_at")
+
+
+def _fields(td: dict[str, Any]) -> tuple[str, str, str, str, str, datetime | None]:
+    """
+    TDnet の1件（_pick_tdnet_dict 済み）から _FIELD_NAMES の順に値を取り出す。
+    各値は一度だけ str/strip する（_first は見つからなければ ""）。
+    str 化が要るかどうか（_str は str ならそのまま返すので、str で来る項目はほぼタダ）:
+    - code: 数値(int)で来ることがある → 要 str 化
+    - title / company_name / url: API上は str だが、壊れたデータで落ちないよう _str を通す
+    - published: parse_dt_utc 側で str 判定/strip する
+    """
+    company_code = _str(_first(td, _CODE_KEYS)).strip()
+    return (
+        _str(_first(td, _TITLE_KEYS)).strip(),
+        company_code,
+        _code4_from_company_code(company_code),
+        _str(_first(td, _NAME_KEYS)).strip(),
+        _str(_first(td, _URL_KEYS)).strip(),
+        parse_dt_utc(_first(td, _PUBLISHED_KEYS)),
     )
 
-    published_raw = td.get("published_at") or td.get("pubdate") or td.get("date") or ""
-    published_at = _parse_dt_maybe(str(published_raw) if published_raw is not None else None)
 
-    company_code_s = str(company_code) if company_code is not None else ""
-    code4 = _code4_from_company_code(company_code_s)
+def _normalize_item(raw: dict[str, Any]) -> dict[str, Any]:
+    td = _pick_tdnet_dict(raw)
+    title, company_code, code4, company_name, doc_url, published_at = _fields(td)
 
     return {
-        "title": str(title).strip(),
-        "company_code": company_code_s.strip(),
+        "title": title,
+        "code": company_code,  # app.py / tests が参照する別名
+        "company_code": company_code,
         "code4": code4,
-        "company_name": str(company_name).strip(),
-        "doc_url": str(doc_url).strip(),
+        "company_name": company_name,
+        "doc_url": doc_url,
         "published_at": published_at,
         "raw": td,  # ここは app.py が救済に使うので維持
     }
 
 
-def _get_json(url: str, timeout: float = 20.0, retries: int = 2) -> dict[str, Any]:
+def _get_json(url: str, timeout: float = 20.0) -> dict[str, Any]:
     """
-    軽いリトライ付きGET。
+    リトライ付きGET（リトライは _SESSION のアダプタ側）。
     """
-    last_err = None
-    for i in range(retries + 1):
-        try:
-            r = requests.get(url, timeout=timeout, headers={"User-Agent": "Mozilla/5.0"})
-            r.raise_for_status()
-            data = r.json()
-            return data if isinstance(data, dict) else {"items": []}
-        except Exception as e:
-            last_err = e
-            if i < retries:
-                time.sleep(0.8 * (i + 1))
-                continue
-            break
-    # 壊れにくさ優先：例外を投げず空扱い
-    return {"items": []}
+    try:
+        r = _SESSION.get(url, timeout=timeout, headers={"User-Agent": "Mozilla/5.0"})
+        r.raise_for_status()
+        body = r.content
+        # 空/0件/items を含まない（エラーページ等）はパースせずに空扱い
+        if not body or body == b'{"items":[]}' or b'"items"' not in body:
+            return {"items": []}
+        # orjson は bytes をそのまま読める（r.json() の text デコードを挟まない）
+        data = orjson.loads(body) if orjson is not None else r.json()
+        return data if isinstance(data, dict) else {"items": []}
+    except Exception:
+        # 壊れにくさ優先：例外を投げず空扱い
+        return {"items": []}
 
 
-def fetch_tdnet_items(code: str | None, limit: int = 200) -> list[dict[str, Any]]:
+def _fetch_raw_items(code: str | None, limit: int) -> list[dict[str, Any]]:
     """
-    code があれば銘柄別、なければrecent。
+    code があれば銘柄別、なければrecent。dict 以外の要素は落とす。
     """
     if code and code.isdigit() and len(code) == 4:
         url = f"{TDNET_BASE}/{code}.json?limit={limit}"
     else:
         url = f"{TDNET_BASE}/recent.json?limit={limit}"
 
-    data = _get_json(url, timeout=20.0, retries=2)
+    data = _get_json(url, timeout=20.0)
     items = data.get("items")
     if not isinstance(items, list):
         return []
+    return [raw for raw in items if isinstance(raw, dict)]
+
+
+def fetch_tdnet_items(code: str | None, limit: int = 200) -> list[dict[str, Any]]:
+    """
+    code があれば銘柄別、なければrecent。
+    """
+    return [_normalize_item(raw) for raw in _fetch_raw_items(code, limit)]
+
+
+def fetch_tdnet_items_columnar(code: str | None, limit: int = 200) -> dict[str, list[Any]]:
+    """
+    fetch_tdnet_items の列指向版（1件ごとの dict を作らず、列ごとの list を返す）。
+    集計/チャート側（pandas.DataFrame など）にそのまま渡せる。raw は含めない。
+    """
+    rows = _fetch_raw_items(code, limit)
+    n = len(rows)
+    cols: list[list[Any]] = [[None] * n for _ in _FIELD_NAMES]
+
+    for i, raw in enumerate(rows):
+        for col, v in zip(cols, _fields(_pick_tdnet_dict(raw))):
+            col[i] = v
 
-    out: list[dict[str, Any]] = []
-    for raw in items:
-        if isinstance(raw, dict):
-            out.append(_normalize_item(raw))
-    return out
+    return dict(zip(_FIELD_NAMES, cols))
@@ -50,6 +50,14 @@ def _fmt_delta_pct(x: Any) -> Optional[str]:
     return None
 
 
+def _as_dict(x: Any) -> Dict[str, Any]:
+    """
+    dict ならそのまま、それ以外（None/list/str など）は空dict。
+    payload は json/orjson 由来の素の dict なので type() で判定する（サブクラスは来ない）。
+    """
+    return x if type(x) is dict else {}
+
+
 def _as_list(x: Any) -> list[str]:
     if x is None:
         return []
@@ -81,6 +89,15 @@ def _progress_value(v: Any) -> Optional[float]:
     return None
 
 
+# 主要4項目: (キー, 表示名, 旧スキーマの yoy% キー)
+_PERF_FIELDS = (
+    ("sales", "売上高", "sales_yoy_pct"),
+    ("op_profit", "営業利益", "op_yoy_pct"),
+    ("ordinary_profit", "経常利益", "ordinary_yoy_pct"),
+    ("net_profit", "純利益", "net_yoy_pct"),
+)
+
+
 # ----------------------------
 # schema normalization
 # ----------------------------
@@ -90,9 +107,8 @@ def _pick_result(payload: Dict[str, Any]) -> Dict[str, Any]:
     新スキーマ: payload["result"] が本体
     旧スキーマ: payload 自体が本体
     """
-    if isinstance(payload.get("result"), dict):
-        return payload["result"]  # type: ignore[return-value]
-    return payload
+    r = payload.get("result")
+    return r if type(r) is dict else payload
 
 
 def _meta_line(payload: Dict[str, Any]) -> str:
@@ -149,81 +165,35 @@ def render_analysis(payload: dict) -> None:
     # ----------------------------
     # 主要数値：売上 / 営業 / 経常 / 純利
     # ----------------------------
-    perf = result.get("performance") or {}
-    # 旧スキーマ互換（もし存在するなら）
-    if not isinstance(perf, dict):
-        perf = {}
-
-    yoy = perf.get("yoy") or {}
-    if not isinstance(yoy, dict):
-        yoy = {}
-
-    # 旧スキーマの yoy %（sales_yoy_pct 等）にも救済対応
-    legacy_yoy_map = {
-        "sales": result.get("performance", {}).get("sales_yoy_pct") if isinstance(result.get("performance"), dict) else None,
-        "op_profit": result.get("performance", {}).get("op_yoy_pct") if isinstance(result.get("performance"), dict) else None,
-        "ordinary_profit": result.get("performance", {}).get("ordinary_yoy_pct") if isinstance(result.get("performance"), dict) else None,
-        "net_profit": result.get("performance", {}).get("net_yoy_pct") if isinstance(result.get("performance"), dict) else None,
-    }
-
-    # 値（数値 or null）
-    sales = perf.get("sales")
-    op = perf.get("op_profit")
-    ordinary = perf.get("ordinary_profit")
-    net = perf.get("net_profit")
-
-    # YoY（%）は新スキーマ yoy.{...} を優先し、無ければ旧を拾う
-    sales_yoy = yoy.get("sales", legacy_yoy_map["sales"])
-    op_yoy = yoy.get("op_profit", legacy_yoy_map["op_profit"])
-    ord_yoy = yoy.get("ordinary_profit", legacy_yoy_map["ordinary_profit"])
-    net_yoy = yoy.get("net_profit", legacy_yoy_map["net_profit"])
-
-    c1, c2, c3, c4 = st.columns(4)
-    with c1:
-        st.metric("売上高", _fmt_num(sales), delta=_fmt_delta_pct(sales_yoy))
-    with c2:
-        st.metric("営業利益", _fmt_num(op), delta=_fmt_delta_pct(op_yoy))
-    with c3:
-        st.metric("経常利益", _fmt_num(ordinary), delta=_fmt_delta_pct(ord_yoy))
-    with c4:
-        st.metric("純利益", _fmt_num(net), delta=_fmt_delta_pct(net_yoy))
+    perf = _as_dict(result.get("performance"))
+    yoy = _as_dict(perf.get("yoy"))
+
+    # 値（数値 or null）。YoY（%）は新スキーマ yoy.{...} を優先し、無ければ旧（sales_yoy_pct 等）を拾う
+    for col, (k, label, legacy_k) in zip(st.columns(4), _PERF_FIELDS):
+        with col:
+            st.metric(label, _fmt_num(perf.get(k)), delta=_fmt_delta_pct(yoy.get(k, perf.get(legacy_k))))
 
     # ----------------------------
     # 進捗（通期）
     # ----------------------------
-    prog = perf.get("progress_full_year") or {}
-    if not isinstance(prog, dict):
-        prog = {}
+    prog = _as_dict(perf.get("progress_full_year"))
+    prog_vals = [(label, _progress_value(prog.get(k))) for k, label, _ in _PERF_FIELDS]
 
-    prog_sales = _progress_value(prog.get("sales"))
-    prog_op = _progress_value(prog.get("op_profit"))
-    prog_ord = _progress_value(prog.get("ordinary_profit"))
-    prog_net = _progress_value(prog.get("net_profit"))
-
-    if any(v is not None for v in [prog_sales, prog_op, prog_ord, prog_net]):
+    if any(v is not None for _, v in prog_vals):
         st.markdown("#### 📊 通期進捗")
-        pc1, pc2 = st.columns(2)
-        with pc1:
-            if prog_sales is not None:
-                st.write(f"売上高：{prog_sales*100:.1f}%")
-                st.progress(prog_sales)
-            if prog_op is not None:
-                st.write(f"営業利益：{prog_op*100:.1f}%")
-                st.progress(prog_op)
-        with pc2:
-            if prog_ord is not None:
-                st.write(f"経常利益：{prog_ord*100:.1f}%")
-                st.progress(prog_ord)
-            if prog_net is not None:
-                st.write(f"純利益：{prog_net*100:.1f}%")
-                st.progress(prog_net)
+        pcols = st.columns(2)
+        # 左: 売上高/営業利益、右: 経常利益/純利益
+        for i, (label, v) in enumerate(prog_vals):
+            if v is None:
+                continue
+            with pcols[i // 2]:
+                st.write(f"{label}：{v*100:.1f}%")
+                st.progress(v)
 
     # ----------------------------
     # 修正（上方/下方/据置など）
     # ----------------------------
-    rev = perf.get("revision") or {}
-    if not isinstance(rev, dict):
-        rev = {}
+    rev = _as_dict(perf.get("revision"))
 
     rev_exists = rev.get("exists")
     rev_dir = rev.get("direction")
@@ -245,29 +215,18 @@ def render_analysis(payload: dict) -> None:
     # ----------------------------
     # ガイダンス（通期予想）
     # ----------------------------
-    guide = result.get("guidance") or {}
-    if not isinstance(guide, dict):
-        guide = {}
-
-    fy = guide.get("full_year_forecast") or {}
-    if not isinstance(fy, dict):
-        fy = {}
+    guide = _as_dict(result.get("guidance"))
+    fy = _as_dict(guide.get("full_year_forecast"))
 
-    has_any_forecast = any(fy.get(k) is not None for k in ("sales", "op_profit", "ordinary_profit", "net_profit"))
+    has_any_forecast = any(fy.get(k) is not None for k, _, _ in _PERF_FIELDS)
     assumptions = _as_list(guide.get("assumptions"))
     notes = guide.get("notes")
 
     if has_any_forecast or assumptions or (isinstance(notes, str) and notes.strip()):
         st.markdown("#### 🗓️ ガイダンス（通期予想）")
-        g1, g2, g3, g4 = st.columns(4)
-        with g1:
-            st.metric("予想 売上高", _fmt_num(fy.get("sales")))
-        with g2:
-            st.metric("予想 営業利益", _fmt_num(fy.get("op_profit")))
-        with g3:
-            st.metric("予想 経常利益", _fmt_num(fy.get("ordinary_profit")))
-        with g4:
-            st.metric("予想 純利益", _fmt_num(fy.get("net_profit")))
+        for col, (k, label, _) in zip(st.columns(4), _PERF_FIELDS):
+            with col:
+                st.metric(f"予想 {label}", _fmt_num(fy.get(k)))
 
         if assumptions:
             with st.expander("前提（assumptions）", expanded=False):
@@ -283,8 +242,8 @@ def render_analysis(payload: dict) -> None:
     next_to_check = _as_list(result.get("next_to_check"))
 
     # 旧スキーマ risks: {short_term, mid_term} っぽい場合救済
-    if not risks and isinstance(result.get("risks"), dict):
-        rdict = result.get("risks")  # type: ignore[assignment]
+    if not risks:
+        rdict = _as_dict(result.get("risks"))
         risks = _as_list(rdict.get("short_term")) + _as_list(rdict.get("mid_term"))
 
     cols = st.columns(3)
@@ -0,0 +1,10 @@
+import pytest
+
+from src.storage import close_all
+
+
+@pytest.fixture(autouse=True)
+def _close_db_connections():
+    # storage は db_path ごとに接続を持ち回すので、テスト毎に閉じて -wal/-shm を残さない
+    yield
+    close_all()
@@ -0,0 +1,120 @@
+import hashlib
+import json
+
+import pytest
+
+import src.analyzer as analyzer
+from src.storage import init_db, get_text_cache, save_text_cache
+
+
+class _FakeResponse:
+    def __init__(self, body: bytes, headers=None):
+        self.body = body
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+
+def _stub_get(monkeypatch, body: bytes, headers=None):
+    monkeypatch.setattr(analyzer._SESSION, "get", lambda *a, **kw: _FakeResponse(body, headers))
+
+
+def test_download_pdf_rejects_content_length_over_limit(monkeypatch):
+    _stub_get(monkeypatch, b"x" * 10, {"Content-Length": str(5 * 1024 * 1024)})
+    f, sha, err = analyzer.download_pdf("https://example.com/a.pdf", max_bytes=1024 * 1024)
+    assert f is None and sha == ""
+    assert "上限" in err
+
+
+def test_download_pdf_rejects_streamed_body_over_limit(monkeypatch):
+    _stub_get(monkeypatch, b"x" * (300 * 1024))
+    f, sha, err = analyzer.download_pdf("https://example.com/a.pdf", max_bytes=200 * 1024)
+    assert f is None and sha == ""
+    assert "上限" in err
+
+
+def test_download_pdf_returns_file_and_sha256(monkeypatch):
+    body = b"%PDF-1.4 fake"
+    _stub_get(monkeypatch, body)
+    f, sha, err = analyzer.download_pdf("https://example.com/a.pdf", max_bytes=1024)
+    assert err == ""
+    assert sha == hashlib.sha256(body).hexdigest()
+    with f:
+        assert f.read() == body
+
+
+def test_sha256_cache_hit_skips_gemini(monkeypatch, tmp_path):
+    body = b"%PDF-1.4 cached"
+    _stub_get(monkeypatch, body)
+
+    def _no_gemini(**kw):
+        raise AssertionError("Gemini should not be called on a cache hit")
+
+    monkeypatch.setattr(analyzer, "_gemini_generate_json", _no_gemini)
+
+    db_path = str(tmp_path / "app.db")
+    init_db(db_path)
+    payload = {
+        "ok": True,
+        "pdf_url": "https://example.com/old.pdf",
+        "model": "m",
+        "prompt_version": analyzer._PROMPT_VERSION,
+        "tokens": 7,
+        "result": {"summary": "cached"},
+    }
+    save_text_cache(db_path, hashlib.sha256(body).hexdigest(), payload=payload)
+
+    res = analyzer.summarize_kessan_pdf_to_json("https://example.com/new.pdf", "k", "m", 1024, db_path=db_path)
+    assert res.ok
+    assert res.payload["result"] == {"summary": "cached"}
+    assert res.payload["pdf_url"] == "https://example.com/new.pdf"
+
+
+def test_failed_analysis_is_not_cached(monkeypatch, tmp_path):
+    body = b"%PDF-1.4 failing"
+    _stub_get(monkeypatch, body)
+    monkeypatch.setattr(analyzer, "extract_text_from_pdf_bytes", lambda pdf, max_pages=35: ("本文", ""))
+    monkeypatch.setattr(analyzer, "_gemini_generate_json", lambda **kw: (None, None, "Gemini呼び出し失敗"))
+
+    db_path = str(tmp_path / "app.db")
+    init_db(db_path)
+
+    res = analyzer.summarize_kessan_pdf_to_json("https://example.com/a.pdf", "k", "m", 1024, db_path=db_path)
+    assert not res.ok
+    assert get_text_cache(db_path, hashlib.sha256(body).hexdigest())[1] is None
+
+
+@pytest.mark.parametrize(
+    "raw",
+    [
+        '{"a": 1}',
+        '```json\n{"a": 1}\n```',
+        '```JSON {"a": 1}```',
+        '  ```\n{"a": 1}\n```  \n',
+    ],
+)
+def test_json_fence_re(raw):
+    assert json.loads(analyzer._JSON_FENCE_RE.sub("", raw)) == {"a": 1}
+
+
+def test_is_retryable():
+    assert analyzer._is_retryable(TimeoutError("t"))
+    assert analyzer._is_retryable(ConnectionResetError())
+    assert not analyzer._is_retryable(ValueError("bad schema"))
+    assert not analyzer._is_retryable(TypeError("bad arg"))
+
+    errors = pytest.importorskip("google.genai.errors")
+    assert analyzer._is_retryable(errors.ClientError(429, {"error": {"message": "rate"}}))
+    assert analyzer._is_retryable(errors.ServerError(503, {}))
+    assert not analyzer._is_retryable(errors.ClientError(400, {"error": {"message": "bad"}}))
@@ -1,25 +1,116 @@
-import tempfile
 from datetime import datetime, timezone
 
-from src.storage import init_db, save_analysis, get_cached_analysis
+from src.storage import (
+    init_db,
+    save_analysis,
+    save_analyses_bulk,
+    get_cached_analysis,
+    get_text_cache,
+    save_text_cache,
+)
 
 
-def test_storage_roundtrip():
-    with tempfile.NamedTemporaryFile(suffix=".db") as f:
-        db_path = f.name
-        init_db(db_path)
+def test_storage_roundtrip(tmp_path):
+    db_path = str(tmp_path / "app.db")
+    init_db(db_path)
+
+    url = "https://example.com/a.pdf"
+    payload = {"summary_1min": "ok", "headline": {"tone": "中立", "score_0_10": 5}}
+    save_analysis(
+        db_path=db_path,
+        doc_url=url,
+        code="7203",
+        title="決算短信",
+        published_at=datetime.now(timezone.utc),
+        payload=payload,
+    )
+
+    got = get_cached_analysis(db_path, url)
+    assert got is not None
+    assert got["summary_1min"] == "ok"
+
+
+def test_text_cache_roundtrip(tmp_path):
+    db_path = str(tmp_path / "app.db")
+    init_db(db_path)
+
+    assert get_text_cache(db_path, "abc") == (None, None)
+
+    save_text_cache(db_path, "abc", text="本文")
+    save_text_cache(db_path, "abc", payload={"ok": True, "result": {"summary": "要約"}})
+
+    text, payload = get_text_cache(db_path, "abc")
+    assert text == "本文"
+    assert payload["result"]["summary"] == "要約"
+
+
+def test_save_analyses_bulk(tmp_path):
+    db_path = str(tmp_path / "app.db")
+    init_db(db_path)
+
+    now = datetime.now(timezone.utc)
+    save_analyses_bulk(
+        db_path,
+        [
+            ("https://example.com/a.pdf", "7203", "決算短信", now, {"result": {"summary": "a"}}),
+            ("https://example.com/b.pdf", "6758", "決算説明資料", now, {"result": {"summary": "b"}}),
+            ("", "0000", "skip", now, {"result": {}}),
+        ],
+    )
+
+    a = get_cached_analysis(db_path, "https://example.com/a.pdf")
+    b = get_cached_analysis(db_path, "https://example.com/b.pdf")
+    assert a["result"]["summary"] == "a"
+    assert a["doc_type"] == "kessan"
+    assert b["doc_type"] == "briefing"
+    assert b["code4"] == "6758"
+
 
-        url = "https://example.com/a.pdf"
-        payload = {"summary_1min": "ok", "headline": {"tone": "中立", "score_0_10": 5}}
-        save_analysis(
-            db_path=db_path,
-            doc_url=url,
-            code="7203",
-            title="決算短信",
-            published_at=datetime.now(timezone.utc),
-            payload=payload,
-        )
-
-        got = get_cached_analysis(db_path, url)
-        assert got is not None
-        assert got["summary_1min"] == "ok"
+def test_cached_analysis_invalidated_on_save(tmp_path):
+    db_path = str(tmp_path / "app.db")
+    init_db(db_path)
+
+    url = "https://example.com/c.pdf"
+    assert get_cached_analysis(db_path, url) is None
+
+    save_analysis(db_path, url, "7203", "決算短信", None, {"summary_1min": "v1"})
+    got = get_cached_analysis(db_path, url)
+    assert got["summary_1min"] == "v1"
+    got["summary_1min"] = "mutated"
+    assert get_cached_analysis(db_path, url)["summary_1min"] == "v1"
+
+    save_analysis(db_path, url, "7203", "決算短信", None, {"summary_1min": "v2"})
+    assert get_cached_analysis(db_path, url)["summary_1min"] == "v2"
+
+
+def test_cached_analysis_does_not_memoize_misses(tmp_path):
+    from src.storage import _connect
+
+    db_path = str(tmp_path / "app.db")
+    init_db(db_path)
+
+    url = "https://example.com/d.pdf"
+    assert get_cached_analysis(db_path, url) is None
+
+    # save_analysis を通さない書き込み（別プロセス等）でも、未保存の結果は残っていない
+    _connect(db_path).execute(
+        "INSERT INTO analyses (doc_url, payload_json) VALUES (?, ?)",
+        (url, '{"summary_1min": "late"}'),
+    )
+    assert get_cached_analysis(db_path, url)["summary_1min"] == "late"
+
+
+def test_init_db_is_read_only_once_migrated(tmp_path):
+    import sqlite3
+
+    db_path = str(tmp_path / "app.db")
+    init_db(db_path)
+
+    # 別接続が書き込みロックを持っていても、移行済みなら init_db は待たずに返る
+    other = sqlite3.connect(db_path, isolation_level=None, timeout=0)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        init_db(db_path)
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
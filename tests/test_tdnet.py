@@ -1,3 +1,5 @@
+import pytest
+
 from src.tdnet import _normalize_item
 
 
@@ -27,3 +29,68 @@ def test_normalize_item_variants():
     it = _normalize_item(raw)
     assert it["code"] == "1234"
     assert it["doc_url"]
+
+
+def test_fetch_tdnet_items_columnar(monkeypatch):
+    import src.tdnet as tdnet
+
+    items = [
+        {"Tdnet": {"title": "決算短信", "company_code": "72030", "document_url": "https://example.com/a.pdf"}},
+        "broken",
+        {"title": "配当予想の修正", "Code": 1234, "date": "2026-02-06 15:00:00"},
+    ]
+    monkeypatch.setattr(tdnet, "_get_json", lambda url, timeout=20.0: {"items": items})
+
+    cols = tdnet.fetch_tdnet_items_columnar("7203")
+    rows = tdnet.fetch_tdnet_items("7203")
+    assert cols["code4"] == ["7203", "1234"]
+    assert cols["published_at"][0] is None
+    assert cols["published_at"][1] == rows[1]["published_at"]
+    for k, col in cols.items():
+        assert col == [r[k] for r in rows]
+
+
+def test_parse_dt_utc_formats():
+    from src.tdnet import parse_dt_utc
+
+    want = parse_dt_utc("2026-02-06T06:00:00Z")
+    assert want is not None
+    for s in ("2026-02-06 15:00:00", "2026/02/06 15:00:00", "2026/02/06 15:00", "2026-02-06T15:00:00+09:00"):
+        assert parse_dt_utc(s) == want
+    assert parse_dt_utc("") is None
+    assert parse_dt_utc("not a date") is None
+
+
+@pytest.mark.parametrize(
+    "s",
+    [
+        "2026-02-06 1 :00:00",
+        "2026-+2-06 15:00:00",
+        "2026-02-06 15:-1:00",
+        "2026-02-06 15:00: 0",
+        "２０２６-02-06 15:00:00",
+        "2026-02-30 15:00:00",
+    ],
+)
+def test_parse_dt_utc_rejects_malformed(s):
+    from src.tdnet import parse_dt_utc
+
+    assert parse_dt_utc(s) is None
+
+
+@pytest.mark.parametrize(
+    "company_code, expected",
+    [
+        ("45230", "4523"),
+        ("12345", "1234"),
+        ("7203", "7203"),
+        (" 7203 ", "7203"),
+        ("123", ""),
+        ("abcd", ""),
+        ("", ""),
+    ],
+)
+def test_code4_from_company_code(company_code, expected):
+    from src.tdnet import _code4_from_company_code
+
+    assert _code4_from_company_code(company_code) == expected